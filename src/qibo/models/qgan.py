@@ -1,9 +1,22 @@
+import functools
 import numpy as np
-from numpy.random import randn
-from qibo import gates, hamiltonians, models, get_backend, K
+from qibo import gates, models, get_backend, K
 from qibo.config import raise_error
 
 
+@functools.lru_cache(maxsize=None)
+def _z_diagonal(nqubits, position):
+    """Diagonal of the single qubit ``hamiltonians.Z`` acting on ``position``.
+
+    The Hamiltonian is diagonal, so only its diagonal is built. Results are
+    cached and shared, so the returned array is read-only.
+    """
+    bits = (np.arange(2 ** nqubits) >> position) & 1
+    diagonal = 2.0 * bits - 1.0
+    diagonal.flags.writeable = False
+    return diagonal
+
+
 class StyleQGAN(object):
     """Model that implements and trains a style-based quantum generative adversarial network.
 
@@ -14,9 +27,11 @@ class StyleQGAN(object):
         layers (int): number of layers for the quantum generator. Provide this value only if not using
             a custom quantum generator.
         circuit (:class:`qibo.core.circuit.Circuit`): custom quantum generator circuit. If not provided,
-            the default quantum circuit will be used.
+            the default quantum circuit will be used. It is created by the first call to ``fit`` and
+            stored in the ``circuit`` attribute, so that it is reused by later fits.
         set_parameters (function): function that creates the array of parameters for the quantum generator.
-            If not provided, the default function will be used.
+            If not provided, the default function will be used. Custom functions are executed eagerly
+            for every sample, so they may also use NumPy operations on the latent points.
 
     Example:
         .. testcode::
@@ -60,8 +75,12 @@ class StyleQGAN(object):
 
         self.discriminator = discriminator
         self.circuit = circuit
+        self.hamiltonians_list = None
         self.layers = layers
         self.latent_dim = latent_dim
+        # seeded from the global state so that ``np.random.seed`` makes the latent points reproducible
+        self._rng = np.random.default_rng(np.random.randint(2 ** 32, dtype=np.uint64))
+        self._latent_buffer = None
         if set_parameters is not None:
             self.set_parameters = set_parameters
         else:
@@ -71,19 +90,12 @@ class StyleQGAN(object):
         """Define the standalone discriminator model."""
         from tensorflow.keras.models import Sequential  # pylint: disable=E0611,E0401
         from tensorflow.keras.optimizers import Adadelta  # pylint: disable=E0611,E0401
-        from tensorflow.keras.layers import Dense, Conv2D, Dropout, Reshape, LeakyReLU, Flatten  # pylint: disable=E0611,E0401
+        from tensorflow.keras.layers import Dense, Dropout, LeakyReLU  # pylint: disable=E0611,E0401
 
         model = Sequential()
-        model.add(Dense(200, use_bias=False, input_dim=self.nqubits))
-        model.add(Reshape((10,10,2)))
-        model.add(Conv2D(64, kernel_size=3, strides=1, padding='same', kernel_initializer='glorot_normal'))
-        model.add(LeakyReLU(alpha=alpha))
-        model.add(Conv2D(32, kernel_size=3, strides=1, padding='same', kernel_initializer='glorot_normal'))
-        model.add(LeakyReLU(alpha=alpha))
-        model.add(Conv2D(16, kernel_size=3, strides=1, padding='same', kernel_initializer='glorot_normal'))
+        model.add(Dense(128, input_dim=self.nqubits))
         model.add(LeakyReLU(alpha=alpha))
-        model.add(Conv2D(8, kernel_size=3, strides=1, padding='same', kernel_initializer='glorot_normal'))
-        model.add(Flatten())
+        model.add(Dense(64))
         model.add(LeakyReLU(alpha=alpha))
         model.add(Dropout(dropout))
         model.add(Dense(1, activation='sigmoid'))
@@ -93,76 +105,124 @@ class StyleQGAN(object):
         model.compile(loss='binary_crossentropy', optimizer=opt, metrics=['accuracy'])
         return model
 
-    def set_params(self, circuit, params, x_input, i):
-        """Set the parameters for the quantum generator circuit."""
-        p = []
-        index = 0
+    def define_parameter_indices(self):
+        """Precompute the latent space indices used by the default ``set_params``.
+
+        Each parameter of the default quantum generator is an affine function
+        of one component of the latent point of the sample. The latent
+        dimension used for every parameter depends only on the circuit layout,
+        so it is computed once before training.
+        """
+        noise_idx = []
         noise = 0
         for l in range(self.layers):
             for q in range(self.nqubits):
-                p.append(params[index]*x_input[noise][i] + params[index+1])
-                index+=2
-                noise=(noise+1)%self.latent_dim
-                p.append(params[index]*x_input[noise][i] + params[index+1])
-                index+=2
-                p.append(params[index]*x_input[noise][i] + params[index+1])
-                index+=2
-                noise=(noise+1)%self.latent_dim
-                p.append(params[index]*x_input[noise][i] + params[index+1])
-                index+=2
-                noise=(noise+1)%self.latent_dim
-            for i in range(0, self.nqubits-1):
-                p.append(params[index]*x_input[noise][i] + params[index+1])
-                index+=2
-                noise=(noise+1)%self.latent_dim
-            p.append(params[index]*x_input[noise][i] + params[index+1])
-            index+=2
-            noise=(noise+1)%self.latent_dim
+                noise_idx.append(noise)
+                noise = (noise + 1) % self.latent_dim
+                noise_idx.extend([noise, noise])
+                noise = (noise + 1) % self.latent_dim
+                noise_idx.append(noise)
+                noise = (noise + 1) % self.latent_dim
+            for q2 in range(0, self.nqubits - 1):
+                noise_idx.append(noise)
+                noise = (noise + 1) % self.latent_dim
+            noise_idx.append(noise)
+            noise = (noise + 1) % self.latent_dim
         for q in range(self.nqubits):
-            p.append(params[index]*x_input[noise][i] + params[index+1])
-            index+=2
-            noise=(noise+1)%self.latent_dim
+            noise_idx.append(noise)
+            noise = (noise + 1) % self.latent_dim
+        self._noise_idx = np.array(noise_idx, dtype=np.int32)
+
+    def set_params(self, circuit, params, x_input, i):
+        """Set the parameters for the quantum generator circuit."""
+        import tensorflow as tf
+        latent = tf.gather(x_input[:, i], self._noise_idx)
+        p = params[0::2] * latent + params[1::2]
         circuit.set_parameters(p)
 
     def generate_latent_points(self, samples):
-        """Generate points in latent space as input for the quantum generator."""
-        # generate points in the latent space
-        x_input = randn(self.latent_dim * samples)
-        # reshape into a batch of inputs for the network
-        x_input = x_input.reshape(samples, self.latent_dim)
+        """Generate points in latent space as input for the quantum generator.
+
+        Returns an array of shape ``(latent_dim, samples)``.
+        """
+        return self._rng.standard_normal((self.latent_dim, samples), dtype=K.qnp.dtypes('DTYPE'))
+
+    def _generate_latent_buffer(self, samples):
+        """Generate latent points in a buffer that is reused by the next call.
+
+        Used during training to avoid allocating the latent points of every batch.
+        """
+        size = self.latent_dim * samples
+        dtype = K.qnp.dtypes('DTYPE')
+        if self._latent_buffer is None or self._latent_buffer.size < size or self._latent_buffer.dtype != dtype:
+            self._latent_buffer = np.empty(size, dtype=dtype)
+        x_input = self._latent_buffer[:size].reshape(self.latent_dim, samples)
+        self._rng.standard_normal(out=x_input, dtype=dtype)
         return x_input
 
-    def generate_fake_samples(self, params, samples, circuit, hamiltonians_list):
+    def execute_generator(self, params, x_input, circuit, hamiltonians_list):
+        """Execute the quantum generator for every column of ``x_input``.
+
+        Returns a tensor of shape ``(samples, nqubits)`` with the expectation
+        values on each final state of the diagonal observables given in
+        ``hamiltonians_list``.
+        """
         import tensorflow as tf
+
+        def generate_sample(i):
+            self.set_parameters(circuit, params, x_input, i)
+            circuit_execute = circuit.execute()
+            if circuit.density_matrix:
+                return tf.math.real(tf.linalg.diag_part(circuit_execute.tensor))
+            return tf.abs(circuit_execute.tensor) ** 2
+
+        # restore the circuit parameters afterwards, so that no tensor of a
+        # traced graph is left in the circuit gates
+        circuit_params = circuit.get_parameters()
+        try:
+            if tf.executing_eagerly():
+                probabilities = tf.stack([generate_sample(i) for i in range(x_input.shape[1])])
+            else:
+                indices = tf.range(tf.shape(x_input)[1])
+                probabilities = tf.map_fn(generate_sample, indices, fn_output_signature=K.dtypes('DTYPE'))
+        finally:
+            circuit.set_parameters(circuit_params)
+        # evaluate all observables on all samples at once
+        observables = tf.cast(tf.stack(hamiltonians_list, axis=1), dtype=probabilities.dtype)
+        return tf.matmul(probabilities, observables)
+
+    def generate_fake_samples(self, params, samples, circuit, hamiltonians_list):
         """Use the generator to generate fake examples, with class labels."""
         # generate points in latent space
         x_input = self.generate_latent_points(samples)
-        x_input = np.transpose(x_input)
         # generator outputs
-        X = []
-        for i in range(self.nqubits):
-            X.append([])
-        # quantum generator circuit
-        for i in range(samples):
-            self.set_parameters(circuit, params, x_input, i)
-            circuit_execute = circuit.execute()
-            for ii in range(self.nqubits):
-                X[ii].append(hamiltonians_list[ii].expectation(circuit_execute))
-        # shape array
-        X = tf.stack([X[i] for i in range(len(X))], axis=1)
+        X = self.execute_generator(params, x_input, circuit, hamiltonians_list)
         # create class labels
         y = np.zeros((samples, 1))
         return X, y
 
     def define_cost_gan(self, params, discriminator, samples, circuit, hamiltonians_list):
+        """Define the combined generator and discriminator model, for updating the generator.
+
+        Args:
+            params: parameters of the quantum generator.
+            discriminator (:class:`tensorflow.keras.models`): classical discriminator.
+            samples (int or array): number of fake samples to generate, or the latent points
+                of shape ``(latent_dim, samples)`` used to generate them.
+            circuit (:class:`qibo.core.circuit.Circuit`): quantum generator circuit.
+            hamiltonians_list (list): diagonals of the observables measured by the generator.
+        """
         import tensorflow as tf
-        """Define the combined generator and discriminator model, for updating the generator."""
-        # generate fake samples
-        x_fake, y_fake = self.generate_fake_samples(params, samples, circuit, hamiltonians_list)
-        # create inverted labels for the fake samples
-        y_fake = np.ones((samples, 1))
+        if isinstance(samples, (int, np.integer)):
+            x_input = self.generate_latent_points(samples)
+        else:
+            x_input = samples
+        # generate fake samples from the latent points
+        x_fake = self.execute_generator(params, x_input, circuit, hamiltonians_list)
         # evaluate discriminator on fake examples
         disc_output = discriminator(x_fake)
+        # use inverted labels for the fake samples
+        y_fake = tf.ones_like(disc_output)
         loss = tf.keras.losses.binary_crossentropy(y_fake, disc_output)
         loss = tf.reduce_mean(loss)
         return loss
@@ -171,57 +231,73 @@ class StyleQGAN(object):
         """Train the quantum generator and classical discriminator."""
         import tensorflow as tf
 
-        def generate_real_samples(samples, distribution, real_samples):
-            """Generate real samples with class labels."""
-            # generate samples from the distribution
-            idx = np.random.randint(real_samples, size=samples)
-            X = distribution[idx,:]
-            # generate class labels
-            y = np.ones((samples, 1))
-            return X, y
-
-        d_loss = []
-        g_loss = []
+        execute_generator = self.execute_generator
+
+        def generator_step(params, x_input):
+            """Compute the generator loss and its gradients."""
+            with tf.GradientTape() as tape:
+                loss = self.define_cost_gan(params, d_model, x_input, circuit, hamiltonians_list)
+            return tape.gradient(loss, params), loss
+
+        if self.set_parameters == self.set_params:
+            # trace the default quantum generator once for all the samples of a batch,
+            # custom parameter functions are executed eagerly as they may not be traceable
+            execute_generator = tf.function(execute_generator, experimental_relax_shapes=True)
+            # trace the generator update once, latent points are drawn outside the graph
+            generator_step = tf.function(generator_step, experimental_relax_shapes=True)
+
+        d_loss = np.empty(self.n_epochs)
+        g_loss = np.empty(self.n_epochs)
         # determine half the size of one batch, for updating the discriminator
         half_samples = int(self.batch_samples / 2)
+        # use the same precision as the circuit simulation
         if self.initial_params is not None:
-            initial_params = tf.Variable(self.initial_params)
+            initial_params = tf.Variable(tf.cast(self.initial_params, K.dtypes('DTYPE')))
         else:
             n = 10 * self.layers * self.nqubits + 2 * self.nqubits
-            initial_params = tf.Variable(np.random.uniform(-0.15, 0.15, n))
+            initial_params = tf.Variable(np.random.uniform(-0.15, 0.15, n), dtype=K.dtypes('DTYPE'))
+        # execute once eagerly so that gate caches and constant matrices are
+        # not created while tracing the generator
+        circuit.execute()
         optimizer = tf.optimizers.Adadelta(learning_rate=self.lr)
-        # prepare real samples
+        # prepare real samples, drawing the indices of all epochs at once
         s = self.reference
+        real_idx = np.random.randint(self.training_samples, size=(self.n_epochs, half_samples))
+        y_real = np.ones((half_samples, 1))
+        y_fake = np.zeros((half_samples, 1))
         # manually enumerate epochs
         for i in range(self.n_epochs):
             # prepare real samples
-            x_real, y_real = generate_real_samples(half_samples, s, self.training_samples)
+            x_real = s[real_idx[i]]
             # prepare fake examples
-            x_fake, y_fake = self.generate_fake_samples(initial_params, half_samples, circuit, hamiltonians_list)
-            # update discriminator
-            d_loss_real, _ = d_model.train_on_batch(x_real, y_real)
-            d_loss_fake, _ = d_model.train_on_batch(x_fake, y_fake)
-            d_loss.append((d_loss_real + d_loss_fake)/2)
+            x_input = self._generate_latent_buffer(half_samples)
+            x_fake = execute_generator(initial_params, x_input, circuit, hamiltonians_list)
+            # update discriminator on real and fake examples in a single batch,
+            # its loss is the average of the real and fake losses
+            x_both = np.concatenate([x_real, x_fake], axis=0)
+            y_both = np.concatenate([y_real, y_fake], axis=0)
+            d_loss[i], _ = d_model.train_on_batch(x_both, y_both)
             # update generator
-            with tf.GradientTape() as tape:
-                loss = self.define_cost_gan(initial_params, d_model, self.batch_samples, circuit, hamiltonians_list)
-            grads = tape.gradient(loss, initial_params)
+            x_input = self._generate_latent_buffer(self.batch_samples)
+            grads, loss = generator_step(initial_params, x_input)
             optimizer.apply_gradients([(grads, initial_params)])
-            g_loss.append(loss)
-            if save:  # pragma: no cover
+            g_loss[i] = loss
+            if save and (i % 100 == 0 or i == self.n_epochs - 1):  # pragma: no cover
                 # saving is skipped in tests to avoid creating files
                 params = (self.nqubits, self.latent_dim, self.layers,
                           self.training_samples, self.batch_samples, self.lr)
                 filename = "_".join(str(p) for p in params)
-                np.savetxt(f"PARAMS_{filename}", [initial_params.numpy()], newline='')
-                np.savetxt(f"dloss_{filename}", [d_loss], newline='')
-                np.savetxt(f"gloss_{filename}", [g_loss], newline='')
+                np.savez(f"checkpoint_{filename}.npz", params=initial_params.numpy(),
+                         d_loss=d_loss[:i+1], g_loss=g_loss[:i+1])
                 # serialize weights to HDF5
                 d_model.save_weights(f"discriminator_{filename}.h5")
+        self.trained_params = initial_params.numpy()
 
     def fit(self, reference, initial_params=None, batch_samples=128, n_epochs=20000, lr=0.5, save=True):
         """Execute qGAN training.
 
+        The trained parameters of the quantum generator are stored in ``trained_params``.
+
         Args:
             reference (array): samples from the reference input distribution.
             initial_parameters (array): initial parameters for the quantum generator. If not provided,
@@ -233,11 +309,12 @@ class StyleQGAN(object):
             lr (float): initial learning rate for the quantum generator.
                 It controls how much to change the model each time the weights are updated.
             save (bool): If ``True`` the results of training (trained parameters and losses)
-                will be saved on disk. Default is ``True``.
+                will be saved on disk every 100 epochs and after the last epoch, as a ``.npz``
+                checkpoint and the discriminator weights. Default is ``True``.
         """
-        if initial_params is None and self.circuit is not None:
+        if initial_params is None and self.layers is None:
             raise_error(ValueError, "Set the initial parameters for your custom quantum generator.")
-        elif initial_params is not None and self.circuit is None:
+        elif initial_params is not None and self.layers is not None:
             raise_error(ValueError, "Define the custom quantum generator to use custom initial parameters.")
 
         self.reference = reference
@@ -247,6 +324,8 @@ class StyleQGAN(object):
         self.batch_samples = batch_samples
         self.n_epochs = n_epochs
         self.lr = lr
+        # reseed from the global state so that seeded fits draw the same latent points
+        self._rng = np.random.default_rng(np.random.randint(2 ** 32, dtype=np.uint64))
 
         # create classical discriminator
         if self.discriminator is None:
@@ -258,8 +337,9 @@ class StyleQGAN(object):
                 raise_error(ValueError, "The number of input neurons in the discriminator has to be equal to "
                             "the number of qubits in the circuit (dimension of the input reference distribution).")
 
-        # create quantum generator
-        if self.circuit is None:
+        # create quantum generator, the default one is reused by later fits
+        # with the same number of qubits
+        if self.layers is not None and (self.circuit is None or self.circuit.nqubits != self.nqubits):
             circuit = models.Circuit(self.nqubits)
             for l in range(self.layers):
                 for q in range(self.nqubits):
@@ -272,34 +352,16 @@ class StyleQGAN(object):
                 circuit.add(gates.CRY(self.nqubits-1, 0, 0))
             for q in range(self.nqubits):
                 circuit.add(gates.RY(q, 0))
-        else:
-            circuit = self.circuit
+            self.circuit = circuit
+            self.define_parameter_indices()
 
-        if circuit.nqubits != self.nqubits:
+        if self.circuit.nqubits != self.nqubits:
                 raise_error(ValueError, "The number of qubits in the circuit has to be equal to "
                             "the number of dimensions in the reference distribution.")
 
         # define hamiltonian to generate fake samples
-        def hamiltonian(nqubits, position):
-            identity = [[1, 0], [0, 1]]
-            m0 = hamiltonians.Z(1).matrix
-            kron = []
-            for i in range(nqubits):
-                if i == position:
-                    kron.append(m0)
-                else:
-                    kron.append(identity)
-            for i in range(nqubits - 1):
-                if i==0:
-                    ham = np.kron(kron[i+1], kron[i])
-                else:
-                    ham = np.kron(kron[i+1], ham)
-            ham = hamiltonians.Hamiltonian(nqubits, ham)
-            return ham
-
-        hamiltonians_list = []
-        for i in range(self.nqubits):
-            hamiltonians_list.append(hamiltonian(self.nqubits, i))
+        if self.hamiltonians_list is None or len(self.hamiltonians_list) != self.nqubits:
+            self.hamiltonians_list = [_z_diagonal(self.nqubits, i) for i in range(self.nqubits)]
 
         # train model
-        self.train(discriminator, circuit, hamiltonians_list, save)
+        self.train(discriminator, self.circuit, self.hamiltonians_list, save)
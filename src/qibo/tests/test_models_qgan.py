@@ -32,6 +32,105 @@ def test_default_qgan():
     qibo.set_backend(original_backend)
 
 
+def test_default_qgan_refit():
+    if not K.check_availability("tensorflow"):  # pragma: no cover
+        pytest.skip("Skipping StyleQGAN test because tensorflow backend is not available.")
+
+    original_backend = qibo.get_backend()
+    qibo.set_backend("tensorflow")
+    reference_distribution = generate_distribution(10)
+    qgan = models.StyleQGAN(latent_dim=2, layers=1)
+    qgan.fit(reference_distribution, batch_samples=8, n_epochs=1, save=False)
+    circuit = qgan.circuit
+    hamiltonians_list = qgan.hamiltonians_list
+    assert circuit.nqubits == 3
+    assert len(hamiltonians_list) == 3
+    qgan.fit(reference_distribution, batch_samples=8, n_epochs=1, save=False)
+    assert qgan.circuit is circuit
+    assert qgan.hamiltonians_list is hamiltonians_list
+    qibo.set_backend(original_backend)
+
+
+def test_default_qgan_after_fit():
+    if not K.check_availability("tensorflow"):  # pragma: no cover
+        pytest.skip("Skipping StyleQGAN test because tensorflow backend is not available.")
+
+    import pickle
+    original_backend = qibo.get_backend()
+    qibo.set_backend("tensorflow")
+    reference_distribution = generate_distribution(10)
+    qgan = models.StyleQGAN(latent_dim=2, layers=1)
+    qgan.fit(reference_distribution, batch_samples=8, n_epochs=1, save=False)
+    # the generator circuit can be executed eagerly after training
+    final_state = qgan.circuit.execute()
+    assert tuple(final_state.shape) == (8,)
+    params = np.random.uniform(-0.15, 0.15, 36)
+    x_fake, y_fake = qgan.generate_fake_samples(params, 4, qgan.circuit, qgan.hamiltonians_list)
+    assert tuple(x_fake.shape) == (4, 3)
+    assert y_fake.shape == (4, 1)
+    loss = qgan.define_cost_gan(params, qgan.define_discriminator(), 4, qgan.circuit, qgan.hamiltonians_list)
+    assert tuple(loss.shape) == ()
+    # the model can be pickled between runs
+    new_qgan = pickle.loads(pickle.dumps(qgan))
+    assert new_qgan.latent_dim == qgan.latent_dim
+    assert new_qgan.circuit.nqubits == 3
+    qibo.set_backend(original_backend)
+
+
+def test_qgan_latent_points():
+    if not K.check_availability("tensorflow"):  # pragma: no cover
+        pytest.skip("Skipping StyleQGAN test because tensorflow backend is not available.")
+
+    original_backend = qibo.get_backend()
+    qibo.set_backend("tensorflow")
+    np.random.seed(123)
+    qgan = models.StyleQGAN(latent_dim=2, layers=1)
+    # latent points can be generated before fit and for any number of samples
+    x1 = qgan.generate_latent_points(5)
+    target_x1 = np.copy(x1)
+    x2 = qgan.generate_latent_points(300)
+    assert x1.shape == (2, 5)
+    assert x2.shape == (2, 300)
+    # returned arrays are not overwritten by later calls
+    np.testing.assert_allclose(x1, target_x1)
+    # seeding the global state makes the latent points reproducible
+    np.random.seed(123)
+    qgan = models.StyleQGAN(latent_dim=2, layers=1)
+    np.testing.assert_allclose(qgan.generate_latent_points(5), x1)
+    qibo.set_backend(original_backend)
+
+
+@pytest.mark.parametrize("precision", ["single", "double"])
+def test_default_qgan_precision(precision):
+    if not K.check_availability("tensorflow"):  # pragma: no cover
+        pytest.skip("Skipping StyleQGAN test because tensorflow backend is not available.")
+
+    import tensorflow as tf
+    original_backend = qibo.get_backend()
+    original_precision = qibo.get_precision()
+    qibo.set_backend("tensorflow")
+    qibo.set_precision(precision)
+    reference_distribution = generate_distribution(10)
+    qgan = models.StyleQGAN(latent_dim=2, layers=1)
+    qgan.fit(reference_distribution, batch_samples=8, n_epochs=1, save=False)
+    x_input = qgan.generate_latent_points(4)
+    assert x_input.shape == (2, 4)
+    assert x_input.dtype == K.qnp.dtypes('DTYPE')
+    assert qgan.trained_params.dtype == K.qnp.dtypes('DTYPE')
+    # custom generator with double precision initial parameters
+    circuit = models.Circuit(3)
+    for q in range(3):
+        circuit.add(gates.RY(q, 0))
+    def set_params(circuit, params, x_input, i):
+        circuit.set_parameters([params[2*q]*x_input[q%2][i] + params[2*q+1] for q in range(3)])
+    initial_params = tf.constant(np.random.uniform(-0.15, 0.15, 6), dtype=tf.float64)
+    qgan = models.StyleQGAN(latent_dim=2, circuit=circuit, set_parameters=set_params)
+    qgan.fit(reference_distribution, initial_params=initial_params, batch_samples=8, n_epochs=1, save=False)
+    assert qgan.trained_params.dtype == K.qnp.dtypes('DTYPE')
+    qibo.set_precision(original_precision)
+    qibo.set_backend(original_backend)
+
+
 def test_custom_qgan():
     if not K.check_availability("tensorflow"):  # pragma: no cover
         pytest.skip("Skipping StyleQGAN test because tensorflow backend is not available.")
@@ -82,6 +181,89 @@ def test_custom_qgan():
     assert qgan.batch_samples == 128
     assert qgan.n_epochs == 1
     assert qgan.lr == 0.5
+    # the custom circuit can still be executed eagerly after training
+    final_state = circuit.execute()
+    assert tuple(final_state.shape) == (2 ** nqubits,)
+    qibo.set_backend(original_backend)
+
+
+def test_custom_qgan_density_matrix():
+    if not K.check_availability("tensorflow"):  # pragma: no cover
+        pytest.skip("Skipping StyleQGAN test because tensorflow backend is not available.")
+
+    original_backend = qibo.get_backend()
+    qibo.set_backend("tensorflow")
+    def set_params(circuit, params, x_input, i):
+        """Set the parameters for the quantum generator circuit."""
+        p = []
+        index = 0
+        noise = 0
+        for q in range(6):
+            p.append(params[index]*x_input[noise][i] + params[index+1])
+            index+=2
+            noise=(noise+1)%2
+        circuit.set_parameters(p)
+
+    nqubits = 3
+    reference_distribution = generate_distribution(10)
+    circuit = models.Circuit(nqubits, density_matrix=True)
+    for q in range(nqubits):
+        circuit.add(gates.RY(q, 0))
+        circuit.add(gates.PauliNoiseChannel(q, px=0.01, pz=0.01))
+    for i in range(0, nqubits - 1):
+        circuit.add(gates.CZ(i, i + 1))
+    for q in range(nqubits):
+        circuit.add(gates.RY(q, 0))
+
+    initial_params = np.random.uniform(-0.15, 0.15, 12)
+    qgan = models.StyleQGAN(latent_dim=2, circuit=circuit, set_parameters=set_params)
+    qgan.fit(reference_distribution, initial_params=initial_params, batch_samples=8, n_epochs=1, save=False)
+    x_fake, _ = qgan.generate_fake_samples(initial_params, 4, circuit, qgan.hamiltonians_list)
+    assert tuple(x_fake.shape) == (4, nqubits)
+    qibo.set_backend(original_backend)
+
+
+def test_custom_qgan_numpy_set_parameters():
+    if not K.check_availability("tensorflow"):  # pragma: no cover
+        pytest.skip("Skipping StyleQGAN test because tensorflow backend is not available.")
+
+    original_backend = qibo.get_backend()
+    qibo.set_backend("tensorflow")
+    def set_params(circuit, params, x_input, i):
+        """Set the parameters using NumPy operations on the latent points."""
+        p = [params[2*q]*np.tanh(x_input[q%2][i]) + params[2*q+1] for q in range(3)]
+        circuit.set_parameters(p)
+
+    nqubits = 3
+    reference_distribution = generate_distribution(10)
+    circuit = models.Circuit(nqubits)
+    for q in range(nqubits):
+        circuit.add(gates.RY(q, 0))
+    initial_params = np.random.uniform(-0.15, 0.15, 6)
+    qgan = models.StyleQGAN(latent_dim=2, circuit=circuit, set_parameters=set_params)
+    qgan.fit(reference_distribution, initial_params=initial_params, batch_samples=8, n_epochs=2, save=False)
+    assert qgan.trained_params.shape == (6,)
+    qibo.set_backend(original_backend)
+
+
+def test_default_qgan_traced_cost():
+    if not K.check_availability("tensorflow"):  # pragma: no cover
+        pytest.skip("Skipping StyleQGAN test because tensorflow backend is not available.")
+
+    import tensorflow as tf
+    original_backend = qibo.get_backend()
+    qibo.set_backend("tensorflow")
+    reference_distribution = generate_distribution(10)
+    qgan = models.StyleQGAN(latent_dim=2, layers=1)
+    qgan.fit(reference_distribution, batch_samples=8, n_epochs=1, save=False)
+    params = tf.Variable(qgan.trained_params)
+    x_input = qgan.generate_latent_points(4)
+    # tracing the generator outside fit does not leave graph tensors in the circuit
+    cost = tf.function(qgan.define_cost_gan)
+    cost(params, qgan.define_discriminator(), x_input, qgan.circuit, qgan.hamiltonians_list)
+    qgan.fit(reference_distribution, batch_samples=8, n_epochs=1, save=False)
+    final_state = qgan.circuit.execute()
+    assert tuple(final_state.shape) == (2 ** 3,)
     qibo.set_backend(original_backend)
 
 
@@ -170,3 +352,64 @@ def test_qgan_circuit_error():
     with pytest.raises(ValueError):
         qgan.fit(reference_distribution, initial_params=initial_params, n_epochs=1, save=False)
     qibo.set_backend(original_backend)
+
+
+def test_default_set_params():
+    if not K.check_availability("tensorflow"):  # pragma: no cover
+        pytest.skip("Skipping StyleQGAN test because tensorflow backend is not available.")
+
+    import tensorflow as tf
+    original_backend = qibo.get_backend()
+    qibo.set_backend("tensorflow")
+
+    class ParametersCircuit:
+        def set_parameters(self, parameters):
+            self.parameters = np.array(parameters)
+
+    def target_params(params, x_input, i, nqubits, nlayers, latent_dim):
+        p = []
+        index = 0
+        noise = 0
+        for l in range(nlayers):
+            for q in range(nqubits):
+                for shift in (1, 0, 1, 1):
+                    p.append(params[index]*x_input[noise][i] + params[index+1])
+                    index+=2
+                    noise=(noise+shift)%latent_dim
+            for q in range(nqubits):
+                p.append(params[index]*x_input[noise][i] + params[index+1])
+                index+=2
+                noise=(noise+1)%latent_dim
+        for q in range(nqubits):
+            p.append(params[index]*x_input[noise][i] + params[index+1])
+            index+=2
+            noise=(noise+1)%latent_dim
+        return np.array(p)
+
+    nqubits, nlayers, latent_dim, samples = 3, 2, 2, 5
+    qgan = models.StyleQGAN(latent_dim=latent_dim, layers=nlayers)
+    qgan.nqubits = nqubits
+    qgan.define_parameter_indices()
+    params = np.random.uniform(-0.15, 0.15, 10 * nlayers * nqubits + 2 * nqubits)
+    x_input = np.random.random((latent_dim, samples))
+    for i in range(samples):
+        circuit = ParametersCircuit()
+        qgan.set_params(circuit, tf.Variable(params), x_input, i)
+        target = target_params(params, x_input, i, nqubits, nlayers, latent_dim)
+        np.testing.assert_allclose(circuit.parameters, target)
+    qibo.set_backend(original_backend)
+
+
+@pytest.mark.parametrize("nqubits", [2, 3, 4])
+def test_qgan_observables(nqubits):
+    from qibo import hamiltonians
+    from qibo.models.qgan import _z_diagonal
+    identity = np.eye(2)
+    m0 = K.to_numpy(hamiltonians.Z(1).matrix)
+    for position in range(nqubits):
+        ham = np.ones((1, 1))
+        for i in range(nqubits):
+            ham = np.kron(m0 if i == position else identity, ham)
+        diagonal = _z_diagonal(nqubits, position)
+        np.testing.assert_allclose(np.diag(diagonal), ham)
+        assert _z_diagonal(nqubits, position) is diagonal